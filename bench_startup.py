@@ -0,0 +1,104 @@
+'''Startup-time benchmark for `python -m limitmanage`.
+
+Runs `--help` and `check` several times in fresh interpreters and fails
+(exit 1) when a command exits with an unexpected status or when its median
+time above a bare interpreter start exceeds its budget, so regressions in
+import-time work are caught before they reach cron.
+`check` runs in a temporary directory with a complete fixture `.env` and
+deleterule, so the success path is measured.
+Sources are byte-compiled first so the numbers do not depend on whether
+`.pyc` files happen to exist (or PYTHONDONTWRITEBYTECODE is set).
+
+  python bench_startup.py [--runs N] [--help-budget-ms MS] [--check-budget-ms MS]
+'''
+import argparse
+import compileall
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FIXTURE_ENV = '''LM_BASE_URL=https://misskey.example/api
+LM_API_TOKEN=bench
+LM_USERAGENT=bench
+LM_POLL_BASE=3
+LM_POLL_NETERROR=300
+LM_POLL_RATELIMIT_BASE=600
+LM_POLL_RATELIMIT_MAX=43200
+LM_LOGLEVEL=INFO
+LM_DEBUGLEVEL=0
+LM_DELETERULE=deleterule.json
+'''
+
+
+def measure(args, runs, cwd, env):
+  '''Return wall times (ms) of `python -m limitmanage <args>`.
+  Raises RuntimeError if the command does not exit with 0.'''
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-m', 'limitmanage', *args], cwd=cwd, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times.append((time.perf_counter() - start) * 1000)
+    if result.returncode != 0:
+      raise RuntimeError(f'{" ".join(args)} exited with {result.returncode}: '
+                         f'{result.stderr.decode("utf-8", "replace").strip()}')
+  return times
+
+
+def baseline(runs):
+  '''Return wall times (ms) of a bare interpreter start, for reference'''
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'])
+    times.append((time.perf_counter() - start) * 1000)
+  return times
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--runs', type=int, default=10)
+  parser.add_argument('--help-budget-ms', type=float, default=60.0,
+                      help='allowed median time of --help above bare interpreter start')
+  parser.add_argument('--check-budget-ms', type=float, default=100.0,
+                      help='allowed median time of check above bare interpreter start')
+  args = parser.parse_args()
+
+  here = os.path.dirname(os.path.abspath(__file__))
+  compileall.compile_dir(here, quiet=1)
+
+  base = statistics.median(baseline(args.runs))
+  print(f'python startup: {base:.1f}ms')
+
+  # keep LM_* of the caller out of the fixture run
+  env = {key: value for key, value in os.environ.items() if not key.startswith('LM_')}
+  env['PYTHONPATH'] = here + os.pathsep + env.get('PYTHONPATH', '')
+
+  ok = True
+  with tempfile.TemporaryDirectory() as fixture:
+    with open(os.path.join(fixture, '.env'), 'w') as f:
+      f.write(FIXTURE_ENV)
+    shutil.copy(os.path.join(here, 'deleterule.json'), fixture)
+
+    for command, budget in ((('--help',), args.help_budget_ms), (('check',), args.check_budget_ms)):
+      try:
+        times = measure(command, args.runs, fixture, env)
+      except RuntimeError as e:
+        print(f'{" ".join(command):8} FAILED {e}')
+        ok = False
+        continue
+      median = statistics.median(times)
+      overhead = median - base
+      status = 'ok' if overhead <= budget else 'SLOW'
+      print(f'{" ".join(command):8} median {median:.1f}ms (+{overhead:.1f}ms, budget {budget:.0f}ms) {status}')
+      ok = ok and overhead <= budget
+
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -23,15 +23,36 @@ def block_all(block_ids):
     print(f' -> block at {datetime.datetime.now()}')
 
 
-if __name__ == '__main__':
+def block_host(host, limiter):
+  print(f'block host: {host}')
+  done = 0
+  for user in limitmanage.for_each_host_user(host, limiter, 'isBlocking'):
+    print(f'block: {user["username"]}@{host} {user["id"]} ({done + 1})')
+    limitmanage.net_runner(limitmanage.blockUser, False, 0, **{"user_id": user['id']})
+    done += 1
+    print(f' -> block at {datetime.datetime.now()}')
+  print(f'block host: {host} blocked {done}')
+
+
+def main(path='block.txt'):
+  limitmanage.setup()
   try:
-    with open('block.txt', 'r') as f:
+    with open(path, 'r') as f:
       block_names_base = f.readlines()
     block_names = list(map(lambda s:s.rstrip("\n"), block_names_base)) # remove new line
     block_names = list(filter(None, block_names)) # remove blank line
+    block_names, block_hosts = limitmanage.split_host_entries(block_names)
     block_ids = convert_userid_from_username(block_names)
     block_all(block_ids)
 
+    limiter = limitmanage.bulk_rate_limiter()
+    for host in block_hosts:
+      block_host(host, limiter)
+
   except Exception as e:
     print(e)
     raise e
+
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,7 @@
 import json
 import logging
 import sys
+import time
 from datetime import datetime, timedelta, timezone
 
 import limitmanage
@@ -77,6 +78,58 @@ def find_latest_exported_json():
   return files[-1]
 
 
+def snapshot_path():
+  '''Columnar note snapshot directory next to the exported json files'''
+  import os
+
+  return os.path.join(os.path.dirname(__file__), 'exported_files', 'snapshot')
+
+
+def snapshot_enabled():
+  return limitmanage.load_env().get('LM_SNAPSHOT', 'False').upper() == 'TRUE'
+
+
+def step2_snapshot(all_notes, fetched_at):
+  '''Write notes to the columnar snapshot. Counts from the exported json are
+  stale, so export-only notes are only added, never used to update rows.'''
+  from limitmanage import snapshot
+
+  logging.info('step 2.3 write notes to snapshot')
+  # the snapshot is a side output: never abort the expire run for it
+  try:
+    added, updated = snapshot.append_notes(
+        snapshot_path(), [n for n in all_notes if n['id'] in fetched_at])
+    added_export, _ = snapshot.append_notes(
+        snapshot_path(), [n for n in all_notes if n['id'] not in fetched_at], update=False)
+    logging.info(f'snapshot added notes: {added + added_export}, updated notes: {updated}')
+  except Exception as e:
+    logging.warning(f'failed to write snapshot: {e}')
+
+
+def step3_snapshot(pinned_ids, config):
+  '''step3 over the columnar snapshot. Returns delete target ids.'''
+  from limitmanage import snapshot
+
+  logging.info('step 3 list delete target from snapshot')
+  notes = snapshot.Snapshot(snapshot_path())
+  now = datetime.now(timezone(timedelta(hours=0)))
+  delete_ids = notes.ids(snapshot.evaluate(notes, config, now, pinned_ids))
+  logging.info(f'delete targets: {len(delete_ids)} of {len(notes)} snapshot notes')
+  notes.close()
+  return delete_ids
+
+
+def step4_snapshot(deleted_ids):
+  '''Mark notes deleted by step4 in the columnar snapshot'''
+  from limitmanage import snapshot
+
+  try:
+    marked = snapshot.mark_deleted(snapshot_path(), deleted_ids)
+    logging.info(f'snapshot marked deleted: {marked}')
+  except Exception as e:
+    logging.warning(f'failed to mark deleted notes in snapshot: {e}')
+
+
 def step1():
   logging.info('step 1 get pinned notes')
   result_i = json.loads(limitmanage.getI())
@@ -86,8 +139,12 @@ def step1():
 
 
 def step2(user_id):
+  '''List all my notes.
+  Returns (notes, fetched_at) where fetched_at maps the id of every note
+  fetched from the API to its fetch epoch time; export-only notes have none.'''
   logging.info('step 2 list all my notes')
   all_notes = []
+  fetched_at = {}
   until_id = None
   while True:
     result_notes_raw = limitmanage.net_runner(limitmanage.getUsersNotes, **{
@@ -98,6 +155,8 @@ def step2(user_id):
     })
     result_notes = json.loads(result_notes_raw)
     all_notes += result_notes
+    now = time.time()
+    fetched_at.update((n['id'], now) for n in result_notes)
 
     if len(result_notes) == 0:
       break
@@ -133,13 +192,80 @@ def step2(user_id):
 
         merged = list(notes_by_id.values())
         logging.info('merged notes count: ' + str(len(merged)))
-        return merged
+        logging.info('export only notes count: ' + str(len(merged) - len(fetched_at)))
+        return merged, fetched_at
     else:
       logging.info('no exported notes json found; skipping step2.2')
   except Exception as e:
     logging.warning(f'failed to merge exported json: {e}')
 
-  return all_notes
+  return all_notes, fetched_at
+
+
+def match_rule(note, pinned_ids, config, now):
+  '''Return the first rule that selects `note` for deletion, or None'''
+  for rule in config:
+    id = note['id']
+    date = datetime.fromisoformat(note['createdAt'])
+    days = rule['day']
+
+    if date + timedelta(days) < now:
+      if rule.get('pinned', False) and id in pinned_ids:
+        logging.debug(f'skip: {id} is pinned at rule{days}')
+        continue
+      else:
+        logging.debug(f'not match: {id} is pinned at rule{days}')
+
+      if rule.get('renote', False) and note.get('renoteId', None) is not None:
+        logging.debug(f'skip: {id} is renote at rule{days}')
+        logging.debug(f'  renoteId: {note.get("renoteId")}')
+        continue
+      else:
+        logging.debug(f'not match: {id} is renote at rule{days}')
+
+      if rule.get('reply', False) and note.get('replyId', None) is not None:
+        logging.debug(f'skip: {id} is reply at rule{days}')
+        logging.debug(f'  replyId: {note.get("replyId")}')
+        continue
+      else:
+        logging.debug(f'not match: {id} is reply at rule{days}')
+
+      if rule.get('inChannel', False) and note.get('channelId', None) is not None:
+        logging.debug(f'skip: {id} in channel at rule{days}')
+        logging.debug(f'  channelId: {note.get("channelId")}')
+        continue
+      else:
+        logging.debug(f'not match: {id} in channel at rule{days}')
+
+      if rule.get('renoteCount', sys.maxsize) <= note.get('renoteCount', 0):
+        logging.debug(f'skip: {id} greater than renoteCount of rule{days}')
+        continue
+      else:
+        logging.debug(f'not match: {id} greater than renoteCount of rule{days}')
+        logging.debug(f'  RULE renoteCount: {rule.get("renoteCount", sys.maxsize)}')
+        logging.debug(f'  NOTE renoteCount: {note.get("renoteCount", 0)}')
+
+      if rule.get('repliesCount', sys.maxsize) <= note.get('repliesCount', 0):
+        logging.debug(f'skip: {id} greater than repliesCount of rule{days}')
+        continue
+      else:
+        logging.debug(f'not match: {id} greater than repliesCount of rule{days}')
+        logging.debug(f'  RULE repliesCount: {rule.get("repliesCount", sys.maxsize)}')
+        logging.debug(f'  NOTE repliesCount: {note.get("repliesCount", 0)}')
+
+      # config uses 'reactionsCount' (plural). Use that key consistently.
+      if rule.get('reactionsCount', sys.maxsize) <= note.get('reactionsCount', 0):
+        logging.debug(f'skip: {id} greater than reactionsCount of rule{days}')
+        continue
+      else:
+        logging.debug(f'not match: {id} greater than reactionsCount of rule{days}')
+        logging.debug(f'  RULE reactionsCount: {rule.get("reactionsCount", sys.maxsize)}')
+        logging.debug(f'  NOTE reactionsCount: {note.get("reactionsCount", 0)}')
+
+      logging.debug(f'add target {id} at rule{days}')
+      return rule
+
+  return None
 
 
 def step3(all_notes, pinned_ids, config):
@@ -147,88 +273,172 @@ def step3(all_notes, pinned_ids, config):
   delete_ids = []
   now = datetime.now(timezone(timedelta(hours=0)))
   for note in all_notes:
-    for rule in config:
-      id = note['id']
-      date = datetime.fromisoformat(note['createdAt'])
-      days = rule['day']
-
-      if date + timedelta(days) < now:
-        if rule.get('pinned', False) and id in pinned_ids:
-          logging.debug(f'skip: {id} is pinned at rule{days}')
-          continue
-        else:
-          logging.debug(f'not match: {id} is pinned at rule{days}')
-
-        if rule.get('renote', False) and note.get('renoteId', None) is not None:
-          logging.debug(f'skip: {id} is renote at rule{days}')
-          logging.debug(f'  renoteId: {note.get("renoteId")}')
-          continue
-        else:
-          logging.debug(f'not match: {id} is renote at rule{days}')
-
-        if rule.get('reply', False) and note.get('replyId', None) is not None:
-          logging.debug(f'skip: {id} is reply at rule{days}')
-          logging.debug(f'  replyId: {note.get("replyId")}')
-          continue
-        else:
-          logging.debug(f'not match: {id} is reply at rule{days}')
-
-        if rule.get('inChannel', False) and note.get('channelId', None) is not None:
-          logging.debug(f'skip: {id} in channel at rule{days}')
-          logging.debug(f'  channelId: {note.get("channelId")}')
-          continue
-        else:
-          logging.debug(f'not match: {id} in channel at rule{days}')
-
-        if rule.get('renoteCount', sys.maxsize) <= note.get('renoteCount', 0):
-          logging.debug(f'skip: {id} greater than renoteCount of rule{days}')
-          continue
-        else:
-          logging.debug(f'not match: {id} greater than renoteCount of rule{days}')
-          logging.debug(f'  RULE renoteCount: {rule.get("renoteCount", sys.maxsize)}')
-          logging.debug(f'  NOTE renoteCount: {note.get("renoteCount", 0)}')
-
-        if rule.get('repliesCount', sys.maxsize) <= note.get('repliesCount', 0):
-          logging.debug(f'skip: {id} greater than repliesCount of rule{days}')
-          continue
-        else:
-          logging.debug(f'not match: {id} greater than repliesCount of rule{days}')
-          logging.debug(f'  RULE repliesCount: {rule.get("repliesCount", sys.maxsize)}')
-          logging.debug(f'  NOTE repliesCount: {note.get("repliesCount", 0)}')
-
-        # config uses 'reactionsCount' (plural). Use that key consistently.
-        if rule.get('reactionsCount', sys.maxsize) <= note.get('reactionsCount', 0):
-          logging.debug(f'skip: {id} greater than reactionsCount of rule{days}')
-          continue
-        else:
-          logging.debug(f'not match: {id} greater than reactionsCount of rule{days}')
-          logging.debug(f'  RULE reactionsCount: {rule.get("reactionsCount", sys.maxsize)}')
-          logging.debug(f'  NOTE reactionsCount: {note.get("reactionsCount", 0)}')
-
-        logging.debug(f'add target {id} at rule{days}')
-        delete_ids.append(id)
-        break
+    if match_rule(note, pinned_ids, config, now) is not None:
+      delete_ids.append(note['id'])
     else:
-      logging.debug(f'skip: {id} is not match deletion rules')
+      logging.debug(f'skip: {note["id"]} is not match deletion rules')
 
   logging.info('delete targets: ' + str(len(delete_ids)))
   return delete_ids
 
 
+def is_borderline(note, rule, margin):
+  '''True if any count of `note` is within `margin` of the keep threshold of `rule`.
+  A margin of 0 never matches: a count at the threshold already keeps the note.'''
+  if margin <= 0:
+    return False
+  for key in ('renoteCount', 'repliesCount', 'reactionsCount'):
+    if key in rule and rule[key] - note.get(key, 0) <= margin:
+      return True
+  return False
+
+
+# fields of a /notes/show result that match_rule needs
+VERIFY_CACHE_FIELDS = ('id', 'createdAt', 'renoteId', 'replyId', 'channelId',
+                       'renoteCount', 'repliesCount', 'reactionsCount')
+
+
+def verify_cache_path():
+  '''Verify cache file shared by consecutive runs (e.g. from cron)'''
+  import os
+
+  return os.path.join(os.path.dirname(__file__), 'exported_files', 'verify-cache.json')
+
+
+def load_verify_cache(ttl):
+  '''Load the verify cache, dropping entries older than `ttl` seconds.
+  Maps note id -> [fetched epoch seconds, note fields or None if gone].'''
+  try:
+    with open(verify_cache_path(), 'r') as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  now = time.time()
+  return {id: entry for id, entry in cache.items() if now - entry[0] < ttl}
+
+
+def save_verify_cache(cache):
+  import os
+
+  path = verify_cache_path()
+  try:
+    with open(path + '.tmp', 'w') as f:
+      json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+  except OSError as e:
+    logging.warning(f'failed to save verify cache: {e}')
+
+
+def mark_deleted_in_verify_cache(deleted_ids):
+  '''Record notes deleted by step4 as gone, so the next run skips them'''
+  if not deleted_ids:
+    return
+  ttl = int(limitmanage.load_env().get('LM_VERIFY_CACHE_TTL') or 300)
+  cache = load_verify_cache(ttl)
+  now = time.time()
+  for id in deleted_ids:
+    cache[id] = [now, None]
+  save_verify_cache(cache)
+
+
+def fetch_note_fresh(note_id, cache):
+  '''Fetch a note via /notes/show unless `cache` has it.
+  Returns the note dict, or None if the note no longer exists.'''
+  cached = cache.get(note_id)
+  if cached is not None:
+    return cached[1]
+
+  # raise400=False: Misskey answers 400 NO_SUCH_NOTE for deleted notes
+  result = limitmanage.net_runner(limitmanage.getNotesShow, False, 0, **{'note_id': note_id})
+  note = None
+  if result is not None:
+    note = {key: value for key, value in json.loads(result).items() if key in VERIFY_CACHE_FIELDS}
+  cache[note_id] = [time.time(), note]
+  return note
+
+
+def step3_verify(all_notes, delete_ids, fetched_at, pinned_ids, config):
+  '''Re-check export-only and stale borderline delete targets against the API.
+
+  Counts in the exported JSON are frozen at export time, so those targets
+  may have become popular or may already be gone. Counts fetched by step2
+  are fresh, unless they were fetched more than LM_VERIFY_STALE seconds ago
+  (long histories take a while to page through); only such stale notes
+  within LM_VERIFY_MARGIN of a keep threshold are re-checked. Drop gone and
+  now-kept notes before step4 so they do not cost a delete call.'''
+  from concurrent.futures import ThreadPoolExecutor, as_completed
+
+  env = limitmanage.load_env()
+  concurrency = int(env.get('LM_VERIFY_CONCURRENCY') or 4)
+  margin = int(env.get('LM_VERIFY_MARGIN') or 0)
+  stale = int(env.get('LM_VERIFY_STALE') or 600)
+  ttl = int(env.get('LM_VERIFY_CACHE_TTL') or 300)
+
+  logging.info('step 3.2 verify export only / borderline delete targets')
+  now = datetime.now(timezone(timedelta(hours=0)))
+  stale_before = time.time() - stale
+  notes_by_id = {n['id']: n for n in all_notes}
+  check_ids = []
+  for id in delete_ids:
+    if id not in fetched_at:
+      check_ids.append(id)
+      continue
+    if fetched_at[id] > stale_before:
+      continue
+    note = notes_by_id[id]
+    rule = match_rule(note, pinned_ids, config, now)
+    if rule is not None and is_borderline(note, rule, margin):
+      check_ids.append(id)
+
+  if not check_ids:
+    logging.info('verify targets: 0')
+    return delete_ids
+
+  logging.info(f'verify targets: {len(check_ids)} (concurrency {concurrency})')
+  gone = set()
+  kept = set()
+  cache = load_verify_cache(ttl)
+  cached = sum(1 for id in check_ids if id in cache)
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    futures = {executor.submit(fetch_note_fresh, id, cache): id for id in check_ids}
+    for future in as_completed(futures):
+      id = futures[future]
+      try:
+        fresh = future.result()
+      except Exception as e:
+        # keep as delete target; step4 handles it as before
+        logging.warning(f'verify failed {id}: {e}')
+        continue
+
+      if fresh is None:
+        logging.debug(f'verify: {id} no longer exists')
+        gone.add(id)
+      elif match_rule(fresh, pinned_ids, config, now) is None:
+        logging.debug(f'verify: {id} now passes keep rules')
+        kept.add(id)
+
+  save_verify_cache(cache)
+  logging.info(f'verify complete: {len(gone)} gone, {len(kept)} now kept; '
+               f'spent {len(check_ids) - cached} /notes/show calls ({cached} from cache), '
+               f'saved {len(gone) + len(kept)} delete calls')
+  return [id for id in delete_ids if id not in gone and id not in kept]
+
+
 def step4(delete_ids):
   logging.info('step 4 delete notes')
   total = len(delete_ids)
-  success = 0
+  deleted_ids = []
   for i, id in enumerate(delete_ids):
     logging.info(f'delete: {id} ({i + 1}/{total})')
     try:
       result = limitmanage.net_runner(limitmanage.deleteNote, True, **{"note_id": id})
       if result:
-        success += 1
+        deleted_ids.append(id)
     except Exception as e:
       logging.error(f'Error deleting {id}: {e}')
 
-  logging.info(f'delete complete: {success}, of {total} targets')
+  logging.info(f'delete complete: {len(deleted_ids)}, of {total} targets')
+  return deleted_ids
 
 
 def fake_step4(delete_ids):
@@ -243,24 +453,50 @@ def fake_step4(delete_ids):
   return delete_ids
 
 
-if __name__ == '__main__':
-  with open(limitmanage.env['LM_DELETERULE'], 'r') as config_file:
+def load_config(path=None):
+  '''Load and validate days expire mode ruleset, sorted by day.
+  Returns None if invalid.'''
+  if path is None:
+    path = limitmanage.load_env().get('LM_DELETERULE', 'deleterule.json')
+  with open(path, 'r') as config_file:
     config_data = json.loads(config_file.read())
   if not is_valid_config(config_data):
-    exit(1)
-  config = sorted(config_data, key=lambda cd: cd['day'])
+    return None
+  return sorted(config_data, key=lambda cd: cd['day'])
 
+
+def main(dry_run=False):
+  config = load_config()
+  if config is None:
+    return 1
+
+  limitmanage.setup()
   try:
     pinned_ids, user_id = step1()
-    all_notes = step2(user_id)
+    all_notes, fetched_at = step2(user_id)
 
-    if limitmanage.env['LM_DELETE_STEP2PRINT'].upper() == 'TRUE':
+    if limitmanage.load_env().get('LM_DELETE_STEP2PRINT', 'False').upper() == 'TRUE':
       print(json.dumps(all_notes))
 
+    if snapshot_enabled():
+      step2_snapshot(all_notes, fetched_at)
+
     delete_ids = step3(all_notes, pinned_ids, config)
-    step4(delete_ids)
-    # fake_step4(delete_ids) # for dry-run
+    delete_ids = step3_verify(all_notes, delete_ids, fetched_at, pinned_ids, config)
+    if dry_run:
+      fake_step4(delete_ids)
+    else:
+      deleted_ids = step4(delete_ids)
+      mark_deleted_in_verify_cache(deleted_ids)
+      if snapshot_enabled():
+        step4_snapshot(deleted_ids)
 
   except Exception as e:
     logging.fatal(e)
     raise e
+
+  return 0
+
+
+if __name__ == '__main__':
+  exit(main())
@@ -1,64 +1,96 @@
-import json
-import logging
+from __future__ import annotations
+
 import os
-import re
 import sys
 import time
-from collections.abc import MutableMapping
-from datetime import datetime, timedelta, timezone
-from typing import Callable, Dict, Optional, ParamSpec, TypeVar
-from urllib import error, request
-
-from dotenv import dotenv_values
-
-P = ParamSpec('P')
-T = TypeVar('T')
-
-
-# load configs from environment
-env = {
-    **dotenv_values('.env'),
-    **os.environ,
-}
-
-# set log level and format
-log_format = '%(asctime)s %(levelname)-8s %(message)s'
-date_format = '%Y-%m-%d %H:%M:%S'
-if env.get('LM_LOGFILE', 'False').upper() == 'TRUE':
-  # Configure basic file logging
-  logging.basicConfig(
-      filename=env.get('LM_LOGFILENAME', 'limitmanage.log'),
-      level=getattr(logging, env['LM_LOGLEVEL'], logging.INFO),
-      format=log_format,
-      datefmt=date_format)
-  # Also add a console (stream) handler so logs are visible on stderr/stdout
-  # TODO: これでログファイルとコンソール両方に出せるそうだが、FILE, CONSOLE, BOTH みたいな選択式にしたいよね
-  console_handler = logging.StreamHandler()
-  console_handler.setLevel(getattr(logging, env['LM_LOGLEVEL'], logging.INFO))
-  console_formatter = logging.Formatter(fmt=log_format, datefmt=date_format)
-  console_handler.setFormatter(console_formatter)
-  logging.getLogger().addHandler(console_handler)
-else:
-  # No file: use basic config to output to console
-  logging.basicConfig(
-      level=getattr(logging, env['LM_LOGLEVEL'], logging.INFO),
-      format=log_format,
-      datefmt=date_format)
-
-# set http debug option
-debuglevel = int(env['LM_DEBUGLEVEL'])
-handler = request.HTTPHandler(debuglevel)
-try:
-  import ssl  # noqa: F401
-  handler_s = request.HTTPSHandler(debuglevel)
-  opener = request.build_opener(handler, handler_s)
-except ImportError:
-  logging.warn('can\'t use ssl')
-  opener = request.build_opener(handler)
-request.install_opener(opener)
-
-# set base url
-baseUrl = env['LM_BASE_URL']
+
+# json, logging, re, datetime and typing are imported where used (or only
+# for type checkers) to keep `import limitmanage` close to a bare start.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+  from datetime import timezone
+  from typing import Callable, Dict, Optional, ParamSpec, TypeVar
+
+  P = ParamSpec('P')
+  T = TypeVar('T')
+
+# Configuration is resolved lazily: importing this module must stay cheap so
+# that `python -m limitmanage --help` and config checks start fast. Nothing
+# below touches `.env`, logging or urllib until `load_env()` / `setup()` is
+# called (API helpers and `net_runner` call `setup()` themselves).
+_env: Optional[Dict] = None
+_log_tz: Optional[timezone] = None
+handler = None
+opener = None
+
+
+def load_env() -> Dict:
+  '''Load configs from `.env` and environment (cached)'''
+  global _env
+  if _env is None:
+    from dotenv import dotenv_values
+
+    _env = {
+        **dotenv_values('.env'),
+        **os.environ,
+    }
+  return _env
+
+
+def setup_logging() -> None:
+  '''Set log level and format from `LM_LOGLEVEL` / `LM_LOGFILE`'''
+  import logging
+
+  env = load_env()
+  log_format = '%(asctime)s %(levelname)-8s %(message)s'
+  date_format = '%Y-%m-%d %H:%M:%S'
+  level = getattr(logging, env.get('LM_LOGLEVEL') or 'INFO', logging.INFO)
+  if env.get('LM_LOGFILE', 'False').upper() == 'TRUE':
+    # Configure basic file logging
+    logging.basicConfig(
+        filename=env.get('LM_LOGFILENAME', 'limitmanage.log'),
+        level=level,
+        format=log_format,
+        datefmt=date_format)
+    # Also add a console (stream) handler so logs are visible on stderr/stdout
+    # TODO: これでログファイルとコンソール両方に出せるそうだが、FILE, CONSOLE, BOTH みたいな選択式にしたいよね
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(level)
+    console_formatter = logging.Formatter(fmt=log_format, datefmt=date_format)
+    console_handler.setFormatter(console_formatter)
+    logging.getLogger().addHandler(console_handler)
+  else:
+    # No file: use basic config to output to console
+    logging.basicConfig(
+        level=level,
+        format=log_format,
+        datefmt=date_format)
+
+
+def setup_opener() -> None:
+  '''Build and install urllib opener with `LM_DEBUGLEVEL` http debug option'''
+  global handler, opener
+  import logging
+  from urllib import request
+
+  debuglevel = int(load_env().get('LM_DEBUGLEVEL') or 0)
+  handler = request.HTTPHandler(debuglevel)
+  try:
+    import ssl  # noqa: F401
+    handler_s = request.HTTPSHandler(debuglevel)
+    opener = request.build_opener(handler, handler_s)
+  except ImportError:
+    logging.warning('can\'t use ssl')
+    opener = request.build_opener(handler)
+  request.install_opener(opener)
+
+
+def setup() -> None:
+  '''Configure logging and http opener once (idempotent)'''
+  if opener is not None:
+    return
+  setup_logging()
+  setup_opener()
 
 
 def _get_log_timezone() -> timezone:
@@ -70,7 +102,11 @@ def _get_log_timezone() -> timezone:
   - parse fixed offset like +09:00
   - fallback to UTC
   """
-  name = env.get('LM_LOG_TIMEZONE')
+  import logging
+  import re
+  from datetime import timedelta, timezone
+
+  name = load_env().get('LM_LOG_TIMEZONE')
   if not name:
     return timezone.utc
 
@@ -105,8 +141,23 @@ def _get_log_timezone() -> timezone:
   return timezone.utc
 
 
-# Logging timezone (configurable via LM_LOG_TIMEZONE, fallback UTC)
-LOG_TZ = _get_log_timezone()
+def get_log_timezone() -> timezone:
+  '''Logging timezone (configurable via LM_LOG_TIMEZONE, fallback UTC, cached)'''
+  global _log_tz
+  if _log_tz is None:
+    _log_tz = _get_log_timezone()
+  return _log_tz
+
+
+def __getattr__(name: str):
+  '''Resolve legacy module attributes (`env`, `baseUrl`, `LOG_TZ`) lazily'''
+  if name == 'env':
+    return load_env()
+  if name == 'baseUrl':
+    return load_env()['LM_BASE_URL']
+  if name == 'LOG_TZ':
+    return get_log_timezone()
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def __remove_none_value_entry(data: Dict):
@@ -116,8 +167,15 @@ def __remove_none_value_entry(data: Dict):
 
 def __post_action(target_url: str, data: Dict, status_container: Optional[Dict] = None):
   '''Do POST to Misskey API'''
+  import json
+  import logging
+  from collections.abc import MutableMapping
+  from urllib import error, request
+
+  setup()
+  env = load_env()
   req = request.Request(
-      baseUrl + target_url,
+      env['LM_BASE_URL'] + target_url,
       data=bytes(json.dumps(data), encoding="utf-8"), method='POST')
   req.add_header('Content-Type', 'application/json')
   req.add_header('user-agent', env['LM_USERAGENT'])
@@ -147,7 +205,7 @@ def getNotes(user_id, until_id, limit=1):
   '''POST Misskey API /notes'''
   targetUrl = '/notes'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'limit': limit,
       'untilId': until_id,
       'userId': user_id,
@@ -159,7 +217,7 @@ def getNotes(user_id, until_id, limit=1):
 def getNotesShow(note_id):
   '''POST Misskey API /notes/show'''
   targetUrl = '/notes/show'
-  data = {'i': env['LM_API_TOKEN'], 'noteId': note_id}
+  data = {'i': load_env()['LM_API_TOKEN'], 'noteId': note_id}
 
   return __post_action(targetUrl, data)
 
@@ -169,7 +227,7 @@ def getUsersNotes(user_id, limit=100,
   '''POST Misskey API /users/notes'''
   targetUrl = '/users/notes'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'limit': limit,
       'includeReplies': include_replies,
       'untilId': until_id,
@@ -182,7 +240,7 @@ def getUsersNotes(user_id, limit=100,
 def getI():
   '''POST Misskey API /i'''
   targetUrl = '/i'
-  data = {'i': env['LM_API_TOKEN']}
+  data = {'i': load_env()['LM_API_TOKEN']}
 
   return __post_action(targetUrl, data)
 
@@ -190,7 +248,7 @@ def getI():
 def deleteNote(note_id):
   '''POST Misskey API /notes/delete'''
   targetUrl = '/notes/delete'
-  data = {'i': env['LM_API_TOKEN'], 'noteId': note_id}
+  data = {'i': load_env()['LM_API_TOKEN'], 'noteId': note_id}
   state_info = {}
 
   __post_action(targetUrl, data, state_info)
@@ -202,7 +260,7 @@ def muteUser(user_id, expire=None):
   '''POST Misskey API /mute/create'''
   targetUrl = '/mute/create'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'userId': user_id,
       'expiresAt': expire,
   }
@@ -214,18 +272,33 @@ def blockUser(user_id):
   '''POST Misskey API /blocking/create'''
   targetUrl = '/blocking/create'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'userId': user_id,
   }
 
   __post_action(targetUrl, data)
 
 
+def getFederationUsers(host, limit=100, until_id=None, since_id=None):
+  '''POST Misskey API /federation/users'''
+  targetUrl = '/federation/users'
+  data = {
+      'i': load_env()['LM_API_TOKEN'],
+      'host': host,
+      'limit': limit,
+      'untilId': until_id,
+      'sinceId': since_id,
+  }
+  return __post_action(targetUrl, __remove_none_value_entry(data))
+
+
 def getUserIdFromUserName(username: str, host: str = None) -> str:
   '''POST Misskey API /users/show'''
+  import json
+
   targetUrl = '/users/show'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'username': username,
       'host': host,
   }
@@ -240,7 +313,7 @@ def getFile(limit=100,
   '''POST Misskey API /drive/files'''
   targetUrl = '/drive/files'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'limit': limit,
       'folderId': folder_id,
       'untilId': until_id,
@@ -255,7 +328,7 @@ def getFolder(limit=100,
   '''POST Misskey API /drive/folders'''
   targetUrl = '/drive/folders'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'limit': limit,
       'folderId': folder_id,
       'untilId': until_id,
@@ -269,7 +342,7 @@ def getAttachedNote(file_id,
   '''POST Misskey API /drive/files/attached-notes'''
   targetUrl = '/drive/files/attached-notes'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'limit': limit,
       'fileId': file_id,
       'untilId': until_id,
@@ -283,7 +356,7 @@ def updateFile(file_id, folder_id=None, name=None,
   '''POST Misskey API /drive/files/update'''
   targetUrl = '/drive/files/update'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'fileId': file_id,
       'folderId': folder_id,
       'name': name,
@@ -297,9 +370,11 @@ def updateFile(file_id, folder_id=None, name=None,
 def createFolder(name,
                  parent_id=None):
   '''POST Misskey API /drive/folders/create'''
+  import json
+
   targetUrl = '/drive/folders/create'
   data = {
-      'i': env['LM_API_TOKEN'],
+      'i': load_env()['LM_API_TOKEN'],
       'name': name,
       'parentId': parent_id,
   }
@@ -310,17 +385,111 @@ def createFolder(name,
 
 def sleepseconds(sec) -> None:
   '''print to stderr with counting down'''
+  import logging
+
   logging.info(f'sleep {sec}sec')
   for t in range(1, sec):
     print('               ', end='\r', file=sys.stderr)
     print(f'wait {t}/{sec}', end='\r', file=sys.stderr)
     time.sleep(1)
 
-  handler.terminator = '\n'
+  if handler is not None:
+    handler.terminator = '\n'
+
+
+class RateLimiter:
+  '''Token bucket for bulk operations: `burst` calls at once, refilled at
+  `per_minute`. Sleeps only when the bucket is empty.'''
+
+  def __init__(self, per_minute: float, burst: int = 1):
+    self.interval = 60.0 / per_minute
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+
+  def wait(self) -> None:
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+    self.updated = now
+    if self.tokens < 1:
+      time.sleep((1 - self.tokens) * self.interval)
+      self.tokens = 1
+      self.updated = time.monotonic()
+    self.tokens -= 1
+
+
+def bulk_rate_limiter() -> RateLimiter:
+  '''RateLimiter from `LM_BULK_RATE` (calls per minute) and `LM_BULK_BURST`'''
+  env = load_env()
+  return RateLimiter(float(env.get('LM_BULK_RATE') or 60), int(env.get('LM_BULK_BURST') or 10))
+
+
+def iter_federation_users(host: str, limiter: Optional[RateLimiter] = None):
+  '''Yield users known on `host`, one /federation/users page at a time'''
+  import json
+
+  until_id = None
+  while True:
+    if limiter is not None:
+      limiter.wait()
+    result = net_runner(getFederationUsers, True, 0, **{
+        'host': host,
+        'until_id': until_id,
+        'limit': 100,
+    })
+    users = json.loads(result)
+    if len(users) == 0:
+      break
+
+    yield from users
+    until_id = users[-1]['id']
+
+
+def is_host_entry(name: str) -> bool:
+  '''`*@host` entries of block/mute lists apply to every known user of the host'''
+  return name.strip().startswith('*@')
+
+
+def host_of_entry(name: str) -> str:
+  '''Normalized host of a `*@host` entry. Raises ValueError if it is not a host name.'''
+  host = name.strip()[2:].strip().lower()
+  if not host or any(c.isspace() or c in '@/*' for c in host):
+    raise ValueError(f'invalid host entry: {name!r}')
+  return host
+
+
+def split_host_entries(names):
+  '''Split list entries into (user names, normalized hosts).
+  Every host entry is validated before returning, so a typo fails before any call.'''
+  hosts = [host_of_entry(name) for name in names if is_host_entry(name)]
+  user_names = [name for name in names if not is_host_entry(name)]
+  return user_names, hosts
+
+
+def for_each_host_user(host: str, limiter: RateLimiter, flag: str):
+  '''Yield users of `host` whose `flag` (e.g. isBlocking, isMuted) is not set.
+  Waits on `limiter` before each yield, so the caller can act right away.'''
+  import logging
+
+  skipped = 0
+  for user in iter_federation_users(host, limiter):
+    if user.get(flag):
+      skipped += 1
+      continue
+    limiter.wait()
+    yield user
+  logging.info(f'host {host}: skipped {skipped} users with {flag}')
 
 
 def net_runner(action: Callable[P, T], raise400=True, wait=None, **kwargs) -> Optional[T]:
   '''net_runnner treatment your network operation for rate limits'''
+  import json
+  import logging
+  from datetime import datetime
+  from urllib import error
+
+  setup()
+  env = load_env()
   logging.debug('start net runner')
   limit_sec = 0
   while True:
@@ -347,7 +516,7 @@ def net_runner(action: Callable[P, T], raise400=True, wait=None, **kwargs) -> Op
 
         if reset_epoch is not None:
           try:
-            reset_time = datetime.fromtimestamp(float(reset_epoch), tz=LOG_TZ).isoformat()
+            reset_time = datetime.fromtimestamp(float(reset_epoch), tz=get_log_timezone()).isoformat()
             logging.info(f'rate limit resets at {reset_time} (epoch: {reset_epoch})')
           except Exception:
             logging.info(f'rate limit resets at epoch: {reset_epoch}')
@@ -0,0 +1,147 @@
+'''Unified entry point: `python -m limitmanage <subcommand>`
+
+Subcommand modules (days_expire, mute_from_list, ...) are imported only
+when their subcommand runs, so `--help` and `check` stay fast.
+'''
+import sys
+
+REQUIRED_ENV_KEYS = (
+    'LM_BASE_URL',
+    'LM_API_TOKEN',
+    'LM_USERAGENT',
+    'LM_POLL_BASE',
+    'LM_POLL_NETERROR',
+    'LM_POLL_RATELIMIT_BASE',
+    'LM_POLL_RATELIMIT_MAX',
+)
+
+
+def cmd_expire(args):
+  import days_expire
+  return days_expire.main(dry_run=args.dry_run)
+
+
+def cmd_mute(args):
+  import mute_from_list
+  mute_from_list.main(args.file)
+  return 0
+
+
+def cmd_block(args):
+  import block_from_list
+  block_from_list.main(args.file)
+  return 0
+
+
+def cmd_snapshot(args):
+  '''Evaluate deleterule over the columnar note snapshot (one /i call for pinned notes)'''
+  import days_expire
+  import limitmanage
+
+  config = days_expire.load_config()
+  if config is None:
+    return 1
+  limitmanage.setup()
+
+  if args.import_export:
+    latest_json = days_expire.find_latest_exported_json()
+    if latest_json is None:
+      print('no exported notes json found', file=sys.stderr)
+      return 1
+    import json
+
+    from limitmanage import snapshot
+    with open(latest_json, 'r') as jf:
+      json_notes = json.load(jf)
+    if isinstance(json_notes, dict):
+      json_notes = json_notes.get('notes', [])
+    # exported counts are stale: add missing notes only, never update rows
+    added, _ = snapshot.append_notes(days_expire.snapshot_path(), json_notes, update=False)
+    print(f'imported {added} notes from {latest_json}, '
+          f'skipped {len(json_notes) - added} already in snapshot', file=sys.stderr)
+
+  pinned_ids, _ = days_expire.step1()
+  print(len(days_expire.step3_snapshot(pinned_ids, config)))
+  return 0
+
+
+def cmd_check(args):
+  '''Validate `.env` and deleterule without network access'''
+  import limitmanage
+
+  env = limitmanage.load_env()
+  ok = True
+  for key in REQUIRED_ENV_KEYS:
+    if not env.get(key):
+      print(f'Configulation error: \'{key}\' must be set', file=sys.stderr)
+      ok = False
+
+  for key in ('LM_POLL_BASE', 'LM_POLL_NETERROR', 'LM_POLL_RATELIMIT_BASE',
+              'LM_POLL_RATELIMIT_MAX', 'LM_DEBUGLEVEL',
+              'LM_VERIFY_CONCURRENCY', 'LM_VERIFY_MARGIN', 'LM_VERIFY_STALE', 'LM_VERIFY_CACHE_TTL',
+              'LM_BULK_BURST'):
+    value = env.get(key)
+    if value and not value.strip().isdigit():
+      print(f'Configulation error: \'{key}\' must be integer', file=sys.stderr)
+      ok = False
+
+  value = env.get('LM_BULK_RATE')
+  if value:
+    try:
+      if float(value) <= 0:
+        raise ValueError
+    except ValueError:
+      print('Configulation error: \'LM_BULK_RATE\' must be a positive number', file=sys.stderr)
+      ok = False
+
+  import days_expire
+  try:
+    if days_expire.load_config() is None:
+      ok = False
+  except (OSError, ValueError) as e:
+    print(f'Configulation error: {e}', file=sys.stderr)
+    ok = False
+
+  if ok:
+    print('ok')
+  return 0 if ok else 1
+
+
+def build_parser():
+  import argparse
+
+  parser = argparse.ArgumentParser(
+      prog='python -m limitmanage',
+      description='Limit manage utils for Misskey')
+  sub = parser.add_subparsers(dest='command', required=True)
+
+  p = sub.add_parser('expire', help='remove old notes by deleterule (days_expire.py)')
+  p.add_argument('--dry-run', action='store_true', help='list delete targets without deleting')
+  p.set_defaults(func=cmd_expire)
+
+  p = sub.add_parser('mute', help='mute users from username list (mute_from_list.py)')
+  p.add_argument('file', nargs='?', default='mute.txt')
+  p.set_defaults(func=cmd_mute)
+
+  p = sub.add_parser('block', help='block users from username list (block_from_list.py)')
+  p.add_argument('file', nargs='?', default='block.txt')
+  p.set_defaults(func=cmd_block)
+
+  p = sub.add_parser('snapshot', help='count delete targets in the note snapshot')
+  p.add_argument('--import-export', action='store_true',
+                 help='append notes from the latest exported json first')
+  p.set_defaults(func=cmd_snapshot)
+
+  p = sub.add_parser('check', help='validate .env and deleterule without network')
+  p.set_defaults(func=cmd_check)
+
+  return parser
+
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+  return args.func(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
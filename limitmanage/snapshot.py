@@ -0,0 +1,465 @@
+'''Columnar on-disk note snapshot.
+
+A snapshot is a directory (default `exported_files/snapshot/`) holding one
+file per fixed-width column plus a string heap for note ids:
+
+  meta.json        count, heap size, newest id, byte order
+  id_offset.col    Q  byte offset of the id in heap.bin
+  id_length.col    H  byte length of the id in heap.bin
+  created.col      q  createdAt as epoch milliseconds
+  renoteCount.col  I
+  repliesCount.col I
+  reactionsCount.col I
+  flags.col        B  FLAG_* bits (renote, reply, channel, deleted)
+  heap.bin            utf-8 note ids, back to back
+
+Rows are kept in ascending id order and columns are memory-mapped for
+reading, so opening a large history costs neither parse time nor RSS.
+
+Writing is incremental: notes newer than `newest_id` are appended and
+`meta.json` is replaced last, so an interrupted append is truncated away by
+the next one. Notes already present get their counts and flags updated in
+place; they are found with one merge pass over the id column, so a refresh
+costs a few microseconds of Python per note passed in. Notes older than `newest_id` that are missing (e.g. from a JSON
+export) are merged by rewriting the snapshot into `<path>.new` and swapping
+directories. Deleted notes are kept as rows with FLAG_DELETED set.
+
+Pinned state is not stored; pass the current pinned ids to `evaluate()`.
+'''
+import json
+import mmap
+import os
+import shutil
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SNAPSHOT_VERSION = 2
+
+FLAG_RENOTE = 1
+FLAG_REPLY = 2
+FLAG_CHANNEL = 4
+FLAG_DELETED = 8
+
+# column name -> array typecode
+COLUMNS = {
+    'id_offset': 'Q',
+    'id_length': 'H',
+    'created': 'q',
+    'renoteCount': 'I',
+    'repliesCount': 'I',
+    'reactionsCount': 'I',
+    'flags': 'B',
+}
+COUNT_COLUMNS = ('renoteCount', 'repliesCount', 'reactionsCount')
+# columns that may change after a note was written
+MUTABLE_COLUMNS = COUNT_COLUMNS + ('flags',)
+# rule key -> flag bit that keeps the note
+RULE_FLAGS = {
+    'renote': FLAG_RENOTE,
+    'reply': FLAG_REPLY,
+    'inChannel': FLAG_CHANNEL,
+}
+
+HEAP_FILE = 'heap.bin'
+META_FILE = 'meta.json'
+DAY_MS = 86400 * 1000
+COUNT_MAX = 0xFFFFFFFF
+
+
+def _numpy():
+  '''Return numpy module if installed, else None'''
+  try:
+    import numpy
+    return numpy
+  except ImportError:
+    return None
+
+
+def _column_file(path: str, name: str) -> str:
+  return os.path.join(path, name + '.col')
+
+
+def _empty_meta() -> Dict:
+  return {'version': SNAPSHOT_VERSION, 'count': 0, 'heap_size': 0,
+          'newest_id': None, 'byteorder': sys.byteorder}
+
+
+def read_meta(path: str) -> Dict:
+  '''Read snapshot meta. Returns an empty meta if no snapshot exists.'''
+  try:
+    with open(os.path.join(path, META_FILE), 'r') as f:
+      meta = json.load(f)
+  except FileNotFoundError:
+    return _empty_meta()
+
+  if meta.get('version') != SNAPSHOT_VERSION:
+    raise ValueError(f'unsupported snapshot version: {meta.get("version")} '
+                     f'(remove {path} to rebuild it)')
+  if meta.get('byteorder') != sys.byteorder:
+    raise ValueError(f'snapshot byte order {meta.get("byteorder")} does not match {sys.byteorder}')
+  return meta
+
+
+def _write_meta(path: str, meta: Dict) -> None:
+  tmp = os.path.join(path, META_FILE + '.tmp')
+  with open(tmp, 'w') as f:
+    json.dump(meta, f)
+  os.replace(tmp, os.path.join(path, META_FILE))
+
+
+def _recover(path: str) -> None:
+  '''Finish or discard an interrupted rewrite (see `_rewrite`)'''
+  new_path = path + '.new'
+  if not os.path.exists(path) and os.path.exists(os.path.join(new_path, META_FILE)):
+    os.rename(new_path, path)
+  shutil.rmtree(new_path, ignore_errors=True)
+  shutil.rmtree(path + '.old', ignore_errors=True)
+
+
+def _epoch_ms(created_at: str) -> int:
+  return int(datetime.fromisoformat(created_at).timestamp() * 1000)
+
+
+def _flags(note: Dict) -> int:
+  flags = 0
+  if note.get('renoteId') is not None:
+    flags |= FLAG_RENOTE
+  if note.get('replyId') is not None:
+    flags |= FLAG_REPLY
+  if note.get('channelId') is not None:
+    flags |= FLAG_CHANNEL
+  return flags
+
+
+def _mutable_values(note: Dict) -> Tuple[int, ...]:
+  '''Values of MUTABLE_COLUMNS for `note`'''
+  get = note.get
+  return (min(get('renoteCount') or 0, COUNT_MAX),
+          min(get('repliesCount') or 0, COUNT_MAX),
+          min(get('reactionsCount') or 0, COUNT_MAX),
+          _flags(note))
+
+
+class _Rows:
+  '''Column arrays and heap being built for a write'''
+
+  def __init__(self, heap_start: int = 0):
+    self.columns = {name: array(code) for name, code in COLUMNS.items()}
+    self.heap = bytearray()
+    self.heap_start = heap_start
+
+  def __len__(self) -> int:
+    return len(self.columns['created'])
+
+  def add(self, raw_id: bytes, created: int, mutable: Tuple[int, ...]) -> None:
+    self.columns['id_offset'].append(self.heap_start + len(self.heap))
+    self.columns['id_length'].append(len(raw_id))
+    self.heap += raw_id
+    self.columns['created'].append(created)
+    for name, value in zip(MUTABLE_COLUMNS, mutable):
+      self.columns[name].append(value)
+
+  def add_note(self, note: Dict) -> None:
+    self.add(note['id'].encode('utf-8'), _epoch_ms(note['createdAt']), _mutable_values(note))
+
+  def write(self, path: str, count: int) -> None:
+    '''Write rows after the first `count` rows (and `heap_start` heap bytes)'''
+    for name, column in self.columns.items():
+      with open(_column_file(path, name), 'a+b') as f:
+        # drop rows of an interrupted append
+        f.truncate(count * column.itemsize)
+        column.tofile(f)
+    with open(os.path.join(path, HEAP_FILE), 'a+b') as f:
+      f.truncate(self.heap_start)
+      f.write(self.heap)
+
+
+def _update_rows(path: str, updates: List[Tuple[int, Tuple[int, ...]]]) -> None:
+  '''Overwrite MUTABLE_COLUMNS of existing rows in place'''
+  for i, name in enumerate(MUTABLE_COLUMNS):
+    code = COLUMNS[name]
+    itemsize = array(code).itemsize
+    with open(_column_file(path, name), 'r+b') as f:
+      for index, values in updates:
+        f.seek(index * itemsize)
+        f.write(array(code, [values[i]]).tobytes())
+
+
+def _rewrite(path: str, snapshot: 'Snapshot', notes: List[Dict]) -> None:
+  '''Merge `notes` (sorted by id, none present yet) with all existing rows.
+
+  The merged snapshot is written to `<path>.new`, then directories are
+  swapped; `_recover` completes the swap if it was interrupted.'''
+  rows = _Rows()
+  existing = len(snapshot)
+  i = 0
+  for note in notes:
+    while i < existing and snapshot.id_at(i) < note['id']:
+      rows.add(snapshot.raw_id_at(i), snapshot.value('created', i),
+               tuple(snapshot.value(name, i) for name in MUTABLE_COLUMNS))
+      i += 1
+    rows.add_note(note)
+  for i in range(i, existing):
+    rows.add(snapshot.raw_id_at(i), snapshot.value('created', i),
+             tuple(snapshot.value(name, i) for name in MUTABLE_COLUMNS))
+
+  new_path = path + '.new'
+  shutil.rmtree(new_path, ignore_errors=True)
+  os.makedirs(new_path)
+  rows.write(new_path, 0)
+  meta = _empty_meta()
+  meta.update({
+      'count': len(rows),
+      'heap_size': len(rows.heap),
+      'newest_id': max(snapshot.meta['newest_id'] or '', notes[-1]['id']),
+  })
+  _write_meta(new_path, meta)
+
+  snapshot.close()
+  if os.path.exists(path):
+    os.rename(path, path + '.old')
+  os.rename(new_path, path)
+  shutil.rmtree(path + '.old', ignore_errors=True)
+
+
+def append_notes(path: str, notes: Iterable[Dict], update: bool = True) -> Tuple[int, int]:
+  '''Write notes into the snapshot.
+
+  Notes newer than the newest stored id are appended, older missing notes
+  are merged in id order, and stored notes get counts/flags refreshed
+  unless `update` is False (use that for stale data such as JSON exports).
+  FLAG_DELETED is never cleared. Returns (added, updated) counts;
+  unchanged or skipped notes count as neither.'''
+  _recover(path)
+  meta = read_meta(path)
+  newest_id = meta['newest_id']
+  snapshot = Snapshot(path)
+
+  newer = []
+  known = []
+  for note in {n['id']: n for n in notes}.values():
+    if newest_id is None or note['id'] > newest_id:
+      newer.append(note)
+    else:
+      known.append(note)
+
+  known.sort(key=lambda n: n['id'])
+  older = []
+  updates = []
+  renotes, replies, reactions, flags = (snapshot._columns[name] for name in MUTABLE_COLUMNS)
+  for note, index in zip(known, snapshot.locate([n['id'] for n in known])):
+    if index is None:
+      older.append(note)
+      continue
+    if not update:
+      continue
+    stored = (renotes[index], replies[index], reactions[index], flags[index])
+    renote, reply, reaction, flag = _mutable_values(note)
+    values = (renote, reply, reaction, flag | stored[3] & FLAG_DELETED)
+    if values != stored:
+      updates.append((index, values))
+
+  if updates:
+    _update_rows(path, updates)
+
+  if older:
+    _rewrite(path, snapshot, sorted(older + newer, key=lambda n: n['id']))
+    return len(older) + len(newer), len(updates)
+
+  snapshot.close()
+  if not newer:
+    return 0, len(updates)
+
+  newer.sort(key=lambda n: n['id'])
+  rows = _Rows(meta['heap_size'])
+  for note in newer:
+    rows.add_note(note)
+
+  os.makedirs(path, exist_ok=True)
+  rows.write(path, meta['count'])
+  meta.update({
+      'count': meta['count'] + len(rows),
+      'heap_size': meta['heap_size'] + len(rows.heap),
+      'newest_id': newer[-1]['id'],
+  })
+  _write_meta(path, meta)
+  return len(newer), len(updates)
+
+
+def mark_deleted(path: str, note_ids: Iterable[str]) -> int:
+  '''Set FLAG_DELETED on stored notes. Returns the number of rows marked.'''
+  _recover(path)
+  snapshot = Snapshot(path)
+  updates = []
+  for note_id in note_ids:
+    index = snapshot.index_of(note_id)
+    if index is None:
+      continue
+    values = tuple(snapshot.value(name, index) for name in MUTABLE_COLUMNS)
+    if not values[-1] & FLAG_DELETED:
+      updates.append((index, values[:-1] + (values[-1] | FLAG_DELETED,)))
+  snapshot.close()
+
+  if updates:
+    _update_rows(path, updates)
+  return len(updates)
+
+
+class Snapshot:
+  '''Read-only memory-mapped view of a snapshot directory'''
+
+  def __init__(self, path: str):
+    self.path = path
+    self.meta = read_meta(path)
+    self.count = self.meta['count']
+    self._maps = []
+    self._columns = {name: self._view(_column_file(path, name), self.count * array(code).itemsize).cast(code)
+                     for name, code in COLUMNS.items()}
+    self._heap = self._view(os.path.join(path, HEAP_FILE), self.meta['heap_size'])
+
+  def _view(self, filename: str, size: int) -> memoryview:
+    if size == 0:
+      return memoryview(b'')
+    with open(filename, 'rb') as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._maps.append(mm)
+    return memoryview(mm)[:size]
+
+  def close(self) -> None:
+    '''Release the mmaps. Arrays returned by `column()` must not be used after.'''
+    views = list(self._columns.values()) + [self._heap]
+    self._columns = {}
+    self._heap = memoryview(b'')
+    for view in views:
+      try:
+        view.release()
+      except BufferError:
+        pass
+    for mm in self._maps:
+      try:
+        mm.close()
+      except BufferError:
+        # still exported by a numpy array; closed when it is collected
+        pass
+    self._maps = []
+
+  def __len__(self) -> int:
+    return self.count
+
+  def column(self, name: str):
+    '''Return a column as numpy array (zero copy) if installed, else memoryview'''
+    np = _numpy()
+    view = self._columns[name]
+    if np is None:
+      return view
+    return np.frombuffer(view, dtype=view.format, count=self.count)
+
+  def value(self, name: str, index: int) -> int:
+    return self._columns[name][index]
+
+  def raw_id_at(self, index: int) -> bytes:
+    offset = self._columns['id_offset'][index]
+    return self._heap[offset:offset + self._columns['id_length'][index]].tobytes()
+
+  def id_at(self, index: int) -> str:
+    return self.raw_id_at(index).decode('utf-8')
+
+  def ids(self, indexes: Iterable[int]) -> List[str]:
+    return [self.id_at(int(i)) for i in indexes]
+
+  def locate(self, note_ids: List[str]) -> List[Optional[int]]:
+    '''Rows of ascending `note_ids` (None if absent), in one merge pass
+    over the id column starting at the first id.'''
+    if not note_ids:
+      return []
+    offsets = self._columns['id_offset']
+    lengths = self._columns['id_length']
+    # slicing the mmap itself yields bytes, which compare like the utf-8 ids
+    heap = self._heap.obj
+    count = self.count
+    index = bisect_left(range(count), note_ids[0], key=self.id_at)
+    result = []
+    for note_id in note_ids:
+      raw_id = note_id.encode('utf-8')
+      while index < count:
+        offset = offsets[index]
+        row_id = heap[offset:offset + lengths[index]]
+        if row_id >= raw_id:
+          break
+        index += 1
+      result.append(index if index < count and row_id == raw_id else None)
+    return result
+
+  def index_of(self, note_id: str) -> Optional[int]:
+    '''Binary search `note_id` (rows are in id order). Returns None if absent.'''
+    index = bisect_left(range(self.count), note_id, key=self.id_at)
+    if index < self.count and self.id_at(index) == note_id:
+      return index
+    return None
+
+
+def evaluate(snapshot: Snapshot, config: List[Dict], now: datetime, pinned_ids: Iterable[str]) -> List[int]:
+  '''Run the days_expire rule set over a snapshot.
+
+  Same semantics as `days_expire.match_rule`: a note is a delete target if
+  any rule it is old enough for has none of its keep conditions met.
+  Rows marked deleted are never targets. Returns row indexes.'''
+  now_ms = int(now.timestamp() * 1000)
+  pinned_index = {i for i in map(snapshot.index_of, pinned_ids) if i is not None}
+  np = _numpy()
+  if np is not None:
+    return _evaluate_numpy(np, snapshot, config, now_ms, pinned_index)
+  return _evaluate_array(snapshot, config, now_ms, pinned_index)
+
+
+def _evaluate_numpy(np, snapshot, config, now_ms, pinned_index):
+  created = snapshot.column('created')
+  flags = snapshot.column('flags')
+  pinned = np.zeros(len(snapshot), dtype=bool)
+  if pinned_index:
+    pinned[list(pinned_index)] = True
+
+  target = np.zeros(len(snapshot), dtype=bool)
+  for rule in config:
+    keep = pinned.copy() if rule.get('pinned', False) else np.zeros(len(snapshot), dtype=bool)
+    for key, flag in RULE_FLAGS.items():
+      if rule.get(key, False):
+        keep |= (flags & flag) != 0
+    for name in COUNT_COLUMNS:
+      if name in rule:
+        keep |= snapshot.column(name) >= rule[name]
+    target |= (created < now_ms - rule['day'] * DAY_MS) & ~keep
+
+  target &= (flags & FLAG_DELETED) == 0
+  return np.flatnonzero(target).tolist()
+
+
+def _evaluate_array(snapshot, config, now_ms, pinned_index):
+  created = snapshot.column('created')
+  flags = snapshot.column('flags')
+  counts = {name: snapshot.column(name) for name in COUNT_COLUMNS}
+  rules = [(
+      now_ms - rule['day'] * DAY_MS,
+      sum(flag for key, flag in RULE_FLAGS.items() if rule.get(key, False)),
+      rule.get('pinned', False),
+      [(counts[name], rule[name]) for name in COUNT_COLUMNS if name in rule],
+  ) for rule in config]
+
+  target = array('Q')
+  for i in range(len(snapshot)):
+    if flags[i] & FLAG_DELETED:
+      continue
+    for limit_ms, keep_flags, keep_pinned, thresholds in rules:
+      if created[i] >= limit_ms:
+        continue
+      if flags[i] & keep_flags or (keep_pinned and i in pinned_index):
+        continue
+      if any(column[i] >= threshold for column, threshold in thresholds):
+        continue
+      target.append(i)
+      break
+
+  return target.tolist()
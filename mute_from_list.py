@@ -23,15 +23,36 @@ def mute_all(mute_ids):
     print(f' -> mute at {datetime.datetime.now()}')
 
 
-if __name__ == '__main__':
+def mute_host(host, limiter):
+  print(f'mute host: {host}')
+  done = 0
+  for user in limitmanage.for_each_host_user(host, limiter, 'isMuted'):
+    print(f'mute: {user["username"]}@{host} {user["id"]} ({done + 1})')
+    limitmanage.net_runner(limitmanage.muteUser, False, 0, **{"user_id": user['id']})
+    done += 1
+    print(f' -> mute at {datetime.datetime.now()}')
+  print(f'mute host: {host} muted {done}')
+
+
+def main(path='mute.txt'):
+  limitmanage.setup()
   try:
-    with open('mute.txt', 'r') as f:
+    with open(path, 'r') as f:
       mute_names_base = f.readlines()
     mute_names = list(map(lambda s:s.rstrip("\n"), mute_names_base)) # remove new line
     mute_names = list(filter(None, mute_names)) # remove blank line
+    mute_names, mute_hosts = limitmanage.split_host_entries(mute_names)
     mute_ids = convert_userid_from_username(mute_names)
     mute_all(mute_ids)
 
+    limiter = limitmanage.bulk_rate_limiter()
+    for host in mute_hosts:
+      mute_host(host, limiter)
+
   except Exception as e:
     print(e)
     raise e
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,136 @@
+import json
+import time
+
+import pytest
+
+import days_expire
+import limitmanage
+
+OLD = '2020-01-01T00:00:00+00:00'
+CONFIG = [{'day': 30, 'renoteCount': 5, 'pinned': True}]
+
+
+@pytest.fixture(autouse=True)
+def env(tmp_path, monkeypatch):
+  env = {'LM_VERIFY_CONCURRENCY': '2'}
+  monkeypatch.setattr(limitmanage, '_env', env)
+  cache_path = str(tmp_path / 'verify-cache.json')
+  monkeypatch.setattr(days_expire, 'verify_cache_path', lambda: cache_path)
+  return env
+
+
+@pytest.fixture
+def notes_show(monkeypatch):
+  '''Stub net_runner: answers /notes/show from `notes_show.notes` and records calls'''
+  class Stub:
+    notes = {}
+    calls = []
+
+    def __call__(self, action, raise400=True, wait=None, **kwargs):
+      assert action is limitmanage.getNotesShow
+      note_id = kwargs['note_id']
+      self.calls.append(note_id)
+      note = self.notes[note_id]
+      if isinstance(note, Exception):
+        raise note
+      return None if note is None else json.dumps(note)
+
+  stub = Stub()
+  monkeypatch.setattr(limitmanage, 'net_runner', stub)
+  return stub
+
+
+def note(id, **counts):
+  return {'id': id, 'createdAt': OLD, **counts}
+
+
+def test_is_borderline():
+  rule = {'day': 30, 'renoteCount': 5}
+  assert days_expire.is_borderline(note('a', renoteCount=4), rule, 1)
+  assert not days_expire.is_borderline(note('a', renoteCount=3), rule, 1)
+  assert days_expire.is_borderline(note('a', renoteCount=3), rule, 2)
+  # zero-count notes under threshold 1 must not all become borderline by default
+  assert not days_expire.is_borderline(note('a'), {'day': 30, 'repliesCount': 1}, 0)
+  assert days_expire.is_borderline(note('a'), {'day': 30, 'repliesCount': 1}, 1)
+  assert not days_expire.is_borderline(note('a', renoteCount=4), {'day': 30}, 3)
+
+
+def test_step3_verify_checks_export_only(notes_show):
+  notes = [note('gone'), note('popular'), note('broken'), note('still'), note('api')]
+  notes_show.notes = {
+      'gone': None,
+      'popular': note('popular', renoteCount=10),
+      'broken': RuntimeError('network'),
+      'still': note('still'),
+  }
+  fetched_at = {'api': time.time()}
+  delete_ids = [n['id'] for n in notes]
+
+  result = days_expire.step3_verify(notes, delete_ids, fetched_at, [], CONFIG)
+
+  # failed verifies stay delete targets, fresh API notes are not re-fetched
+  assert result == ['broken', 'still', 'api']
+  assert sorted(notes_show.calls) == ['broken', 'gone', 'popular', 'still']
+
+
+def test_step3_verify_borderline_only_when_stale(notes_show, env, caplog):
+  env['LM_VERIFY_MARGIN'] = '1'
+  notes = [note('fresh', renoteCount=4), note('stale', renoteCount=4), note('zero')]
+  notes_show.notes = {'stale': note('stale', renoteCount=5)}
+  fetched_at = {'fresh': time.time(), 'stale': time.time() - 3600, 'zero': time.time() - 3600}
+
+  with caplog.at_level('INFO'):
+    result = days_expire.step3_verify(notes, ['fresh', 'stale', 'zero'], fetched_at, [], CONFIG)
+
+  assert result == ['fresh', 'zero']
+  assert notes_show.calls == ['stale']
+  assert 'spent 1 /notes/show calls (0 from cache), saved 1 delete calls' in caplog.text
+
+
+def test_step3_verify_zero_margin_fetches_nothing(notes_show):
+  notes = [note(str(i)) for i in range(50)]
+  fetched_at = {n['id']: time.time() - 3600 for n in notes}
+  delete_ids = [n['id'] for n in notes]
+
+  assert days_expire.step3_verify(notes, delete_ids, fetched_at, [], CONFIG) == delete_ids
+  assert notes_show.calls == []
+
+
+def test_verify_cache_is_reused_across_runs(notes_show, caplog):
+  notes = [note('gone')]
+  notes_show.notes = {'gone': None}
+  days_expire.step3_verify(notes, ['gone'], {}, [], CONFIG)
+  with caplog.at_level('INFO'):
+    assert days_expire.step3_verify(notes, ['gone'], {}, [], CONFIG) == []
+  assert notes_show.calls == ['gone']
+  assert 'spent 0 /notes/show calls (1 from cache)' in caplog.text
+
+
+def test_load_verify_cache_drops_expired():
+  now = time.time()
+  days_expire.save_verify_cache({
+      'new': [now - 10, None],
+      'old': [now - 1000, note('old')],
+  })
+  assert days_expire.load_verify_cache(300) == {'new': [now - 10, None]}
+  assert set(days_expire.load_verify_cache(3600)) == {'new', 'old'}
+
+
+def test_load_verify_cache_missing_or_broken(tmp_path):
+  assert days_expire.load_verify_cache(300) == {}
+  with open(days_expire.verify_cache_path(), 'w') as f:
+    f.write('{broken')
+  assert days_expire.load_verify_cache(300) == {}
+
+
+def test_mark_deleted_in_verify_cache(notes_show):
+  days_expire.save_verify_cache({'a': [time.time(), note('a')]})
+  days_expire.mark_deleted_in_verify_cache(['a', 'b'])
+  cache = days_expire.load_verify_cache(300)
+  assert cache['a'][1] is None
+  assert cache['b'][1] is None
+
+  # the next run treats them as gone without an API call
+  notes_show.notes = {}
+  assert days_expire.step3_verify([note('a')], ['a'], {}, [], CONFIG) == []
+  assert notes_show.calls == []
@@ -0,0 +1,144 @@
+import json
+
+import pytest
+
+import block_from_list
+import limitmanage
+import mute_from_list
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  '''Fake time.monotonic/time.sleep: sleeping advances the clock and is recorded'''
+  class Clock:
+    now = 1000.0
+    sleeps = []
+
+    def monotonic(self):
+      return self.now
+
+    def sleep(self, seconds):
+      self.sleeps.append(seconds)
+      self.now += seconds
+
+  clock = Clock()
+  monkeypatch.setattr(limitmanage.time, 'monotonic', clock.monotonic)
+  monkeypatch.setattr(limitmanage.time, 'sleep', clock.sleep)
+  return clock
+
+
+class NoLimit:
+  waits = 0
+
+  def wait(self):
+    self.waits += 1
+
+
+@pytest.fixture
+def federation(monkeypatch):
+  '''Stub net_runner: serves /federation/users pages from `federation.pages`
+  and records the other actions with their user ids'''
+  class Stub:
+    pages = []
+    until_ids = []
+    actions = []
+
+    def __call__(self, action, raise400=True, wait=None, **kwargs):
+      if action is limitmanage.getFederationUsers:
+        self.until_ids.append(kwargs['until_id'])
+        return json.dumps(self.pages[len(self.until_ids) - 1])
+      self.actions.append((action, kwargs['user_id']))
+      return None
+
+  stub = Stub()
+  monkeypatch.setattr(limitmanage, 'net_runner', stub)
+  return stub
+
+
+def user(id, **flags):
+  return {'id': id, 'username': f'u{id}', **flags}
+
+
+def test_rate_limiter_burst_then_pacing(clock):
+  limiter = limitmanage.RateLimiter(per_minute=60, burst=3)
+  for _ in range(3):
+    limiter.wait()
+  assert clock.sleeps == []
+
+  limiter.wait()
+  limiter.wait()
+  assert clock.sleeps == [pytest.approx(1.0), pytest.approx(1.0)]
+
+
+def test_rate_limiter_refills_up_to_burst(clock):
+  limiter = limitmanage.RateLimiter(per_minute=60, burst=2)
+  limiter.wait()
+  limiter.wait()
+  clock.now += 3600
+  limiter.wait()
+  limiter.wait()
+  assert clock.sleeps == []
+
+  limiter.wait()
+  assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_rate_limiter_partial_refill(clock):
+  limiter = limitmanage.RateLimiter(per_minute=60, burst=1)
+  limiter.wait()
+  clock.now += 0.25
+  limiter.wait()
+  assert clock.sleeps == [pytest.approx(0.75)]
+
+
+def test_iter_federation_users_pages(federation):
+  federation.pages = [[user('a'), user('b')], [user('c')], []]
+  limiter = NoLimit()
+  users = list(limitmanage.iter_federation_users('example.com', limiter))
+  assert [u['id'] for u in users] == ['a', 'b', 'c']
+  assert federation.until_ids == [None, 'b', 'c']
+  assert limiter.waits == 3
+
+
+def test_iter_federation_users_empty_host(federation):
+  federation.pages = [[]]
+  assert list(limitmanage.iter_federation_users('example.com')) == []
+  assert federation.until_ids == [None]
+
+
+@pytest.mark.parametrize('entry, host', [
+    ('*@example.com', 'example.com'),
+    ('  *@Example.COM  ', 'example.com'),
+    ('*@ misskey.example ', 'misskey.example'),
+])
+def test_host_of_entry(entry, host):
+  assert limitmanage.is_host_entry(entry)
+  assert limitmanage.host_of_entry(entry) == host
+
+
+@pytest.mark.parametrize('entry', ['*@', '*@  ', '*@a b', '*@user@example.com',
+                                   '*@example.com/path', '*@*.example.com'])
+def test_host_of_entry_rejects(entry):
+  with pytest.raises(ValueError):
+    limitmanage.host_of_entry(entry)
+
+
+def test_split_host_entries():
+  names = ['alice', '*@Example.com', 'bob@remote.example']
+  assert limitmanage.split_host_entries(names) == (['alice', 'bob@remote.example'], ['example.com'])
+  with pytest.raises(ValueError):
+    limitmanage.split_host_entries(['alice', '*@bad host'])
+
+
+@pytest.mark.parametrize('host_action, action, flag', [
+    (block_from_list.block_host, 'blockUser', 'isBlocking'),
+    (mute_from_list.mute_host, 'muteUser', 'isMuted'),
+])
+def test_host_skips_flagged_users(federation, host_action, action, flag):
+  federation.pages = [[user('a'), user('b', **{flag: True})], [user('c')], []]
+  limiter = NoLimit()
+  host_action('example.com', limiter)
+  action = getattr(limitmanage, action)
+  assert federation.actions == [(action, 'a'), (action, 'c')]
+  # one wait per page and one per action
+  assert limiter.waits == 3 + 2
@@ -0,0 +1,185 @@
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import days_expire
+from limitmanage import snapshot
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+CONFIG = sorted([
+    {'day': 30, 'renoteCount': 1, 'repliesCount': 1, 'reactionsCount': 1,
+     'pinned': True, 'renote': True, 'reply': True, 'inChannel': True},
+    {'day': 60, 'renoteCount': 5, 'repliesCount': 5, 'reactionsCount': 5, 'pinned': True},
+    {'day': 180, 'pinned': True},
+], key=lambda rule: rule['day'])
+
+
+def make_notes(count, seed=1):
+  rand = random.Random(seed)
+  notes = []
+  for i in range(count):
+    note = {
+        'id': f'{i:010x}',
+        'createdAt': (NOW - timedelta(days=rand.randint(0, 400), seconds=rand.randint(0, 86399))).isoformat(),
+        'renoteCount': rand.randint(0, 7),
+        'repliesCount': rand.randint(0, 7),
+        'reactionsCount': rand.randint(0, 7),
+    }
+    for key in ('renoteId', 'replyId', 'channelId'):
+      if rand.random() < 0.2:
+        note[key] = 'x'
+    notes.append(note)
+  return notes
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def evaluator(request, monkeypatch):
+  if request.param == 'numpy':
+    pytest.importorskip('numpy')
+  else:
+    monkeypatch.setattr(snapshot, '_numpy', lambda: None)
+  return request.param
+
+
+def evaluate_ids(path, pinned_ids=(), config=CONFIG):
+  notes = snapshot.Snapshot(path)
+  try:
+    return notes.ids(snapshot.evaluate(notes, config, NOW, pinned_ids))
+  finally:
+    notes.close()
+
+
+def test_evaluate_matches_step3(tmp_path, monkeypatch, evaluator):
+  notes = make_notes(3000)
+  pinned_ids = [notes[5]['id'], notes[1000]['id'], 'not-in-snapshot']
+  monkeypatch.setattr(days_expire, 'datetime', type('fixed', (datetime,), {'now': staticmethod(lambda tz=None: NOW)}))
+  expected = days_expire.step3(notes, pinned_ids, CONFIG)
+
+  snapshot.append_notes(str(tmp_path), notes)
+  assert sorted(evaluate_ids(str(tmp_path), pinned_ids)) == sorted(expected)
+
+
+def test_empty_snapshot(tmp_path, evaluator):
+  path = str(tmp_path / 'missing')
+  notes = snapshot.Snapshot(path)
+  assert len(notes) == 0
+  assert notes.index_of('abc') is None
+  assert snapshot.evaluate(notes, CONFIG, NOW, ['abc']) == []
+  assert snapshot.append_notes(path, []) == (0, 0)
+  assert snapshot.mark_deleted(path, ['abc']) == 0
+
+
+def test_incremental_append(tmp_path):
+  notes = make_notes(100)
+  assert snapshot.append_notes(str(tmp_path), notes[:60]) == (60, 0)
+  assert snapshot.append_notes(str(tmp_path), notes) == (40, 0)
+  assert snapshot.append_notes(str(tmp_path), notes) == (0, 0)
+
+  loaded = snapshot.Snapshot(str(tmp_path))
+  assert loaded.ids(range(len(loaded))) == [n['id'] for n in notes]
+  loaded.close()
+
+
+def test_interrupted_append(tmp_path):
+  path = str(tmp_path)
+  notes = make_notes(50)
+  snapshot.append_notes(path, notes[:30])
+  # a crash after writing columns but before replacing meta.json
+  for name in snapshot.COLUMNS:
+    with open(snapshot._column_file(path, name), 'ab') as f:
+      f.write(b'\xff' * 17)
+  with open(os.path.join(path, snapshot.HEAP_FILE), 'ab') as f:
+    f.write(b'garbage')
+
+  loaded = snapshot.Snapshot(path)
+  assert len(loaded) == 30
+  loaded.close()
+
+  assert snapshot.append_notes(path, notes) == (20, 0)
+  clean = str(tmp_path / 'clean')
+  snapshot.append_notes(clean, notes)
+  for name in list(snapshot.COLUMNS) + ['heap']:
+    filename = os.path.join(path, snapshot.HEAP_FILE) if name == 'heap' else snapshot._column_file(path, name)
+    clean_filename = filename.replace(path, clean, 1)
+    with open(filename, 'rb') as f, open(clean_filename, 'rb') as g:
+      assert f.read() == g.read(), name
+
+
+def test_merge_older_notes(tmp_path):
+  path = str(tmp_path / 'snapshot')
+  newer = {'id': '9z', 'createdAt': '2025-06-01T00:00:00+00:00'}
+  older = {'id': '1a', 'createdAt': '2025-01-01T00:00:00+00:00', 'renoteCount': 3}
+  snapshot.append_notes(path, [newer])
+  assert snapshot.append_notes(path, [older], update=False) == (1, 0)
+
+  loaded = snapshot.Snapshot(path)
+  assert loaded.ids(range(len(loaded))) == ['1a', '9z']
+  assert loaded.index_of('1a') == 0
+  assert loaded.value('renoteCount', 0) == 3
+  assert loaded.meta['newest_id'] == '9z'
+  loaded.close()
+  assert not os.path.exists(path + '.new')
+  assert not os.path.exists(path + '.old')
+
+
+def test_interrupted_rewrite_is_recovered(tmp_path):
+  path = str(tmp_path / 'snapshot')
+  notes = make_notes(10)
+  snapshot.append_notes(path, notes[5:])
+  snapshot.append_notes(path, notes[:5])
+  # a crash after moving the old snapshot away but before moving the new one in
+  os.rename(path, path + '.new')
+
+  assert snapshot.append_notes(path, notes) == (0, 0)
+  loaded = snapshot.Snapshot(path)
+  assert len(loaded) == 10
+  loaded.close()
+
+
+def test_update_and_tombstone(tmp_path, evaluator):
+  path = str(tmp_path)
+  config = [{'day': 30, 'renoteCount': 5, 'pinned': True}]
+  note = {'id': 'a1', 'createdAt': '2020-01-01T00:00:00+00:00', 'renoteCount': 0}
+  snapshot.append_notes(path, [note])
+  assert evaluate_ids(path, config=config) == ['a1']
+  assert evaluate_ids(path, ['a1'], config) == []
+
+  popular = dict(note, renoteCount=10)
+  assert snapshot.append_notes(path, [popular], update=False) == (0, 0)
+  assert evaluate_ids(path, config=config) == ['a1']
+  assert snapshot.append_notes(path, [popular]) == (0, 1)
+  assert evaluate_ids(path, config=config) == []
+
+  assert snapshot.append_notes(path, [note]) == (0, 1)
+  assert snapshot.mark_deleted(path, ['a1', 'unknown']) == 1
+  assert evaluate_ids(path, config=config) == []
+  # stale data never resurrects a deleted note
+  assert snapshot.append_notes(path, [note]) == (0, 0)
+  assert evaluate_ids(path, config=config) == []
+
+
+def test_snapshot_errors_do_not_abort_expire(tmp_path, monkeypatch, caplog):
+  path = tmp_path / 'snapshot'
+  path.mkdir()
+  (path / snapshot.META_FILE).write_text('{"version": 1}')
+  monkeypatch.setattr(days_expire, 'snapshot_path', lambda: str(path))
+  notes = make_notes(3)
+
+  days_expire.step2_snapshot(notes, {n['id']: 0 for n in notes})
+  days_expire.step4_snapshot([notes[0]['id']])
+  assert 'failed to write snapshot: unsupported snapshot version: 1' in caplog.text
+  assert 'failed to mark deleted notes in snapshot' in caplog.text
+
+
+def test_locate_merge_pass(tmp_path):
+  notes = make_notes(100)
+  snapshot.append_notes(str(tmp_path), notes[10:90:2])
+  loaded = snapshot.Snapshot(str(tmp_path))
+  ids = sorted(n['id'] for n in notes)
+  expected = [loaded.index_of(note_id) for note_id in ids]
+  assert loaded.locate(ids) == expected
+  assert [i for i in expected if i is not None] == list(range(40))
+  assert loaded.locate([]) == []
+  loaded.close()